@@ -0,0 +1,111 @@
+"""Event-loop lag under a synthetic error storm, before and after queued logging.
+
+Spawns many tasks that log "Progress update error" style failures the way
+handlers do during a FloodWait storm, while a monitor task measures how late
+its periodic wake-ups are. Compares the old synchronous basicConfig handler
+with the queue-backed handler from bot_logging, with and without dedup.
+
+    python bench_logging.py --seconds 5 --tasks 200 --sink-latency 0.0002
+"""
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+from bot_logging import setup_logging
+
+MONITOR_INTERVAL = 0.005
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+class SlowStream:
+    # Emulates stderr backed by a pipe to a slow log collector
+    def __init__(self, stream, latency):
+        self.stream = stream
+        self.latency = latency
+
+    def write(self, data):
+        time.sleep(self.latency)
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+def setup_sync_logging(stream):
+    root = logging.getLogger()
+    root.handlers[:] = []
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        stream=stream,
+        force=True
+    )
+
+async def monitor_lag(lags, stop):
+    while not stop.is_set():
+        expected = time.perf_counter() + MONITOR_INTERVAL
+        await asyncio.sleep(MONITOR_INTERVAL)
+        lags.append(max(0.0, time.perf_counter() - expected))
+
+async def error_storm(task_id, counter, stop):
+    logger = logging.getLogger("bench")
+    i = 0
+    while not stop.is_set():
+        try:
+            raise RuntimeError(f"Telegram says: [420 FLOOD_WAIT_X] - A wait of {task_id + i} seconds is required")
+        except RuntimeError as e:
+            logger.error(f"Progress update error: {e}")
+        counter[0] += 1
+        i += 1
+        await asyncio.sleep(0.001)
+
+async def run_scenario(seconds, tasks):
+    stop = asyncio.Event()
+    lags = []
+    counter = [0]
+    workers = [asyncio.create_task(error_storm(i, counter, stop)) for i in range(tasks)]
+    monitor = asyncio.create_task(monitor_lag(lags, stop))
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(monitor, *workers)
+    return lags, counter[0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--tasks', type=int, default=200)
+    parser.add_argument('--stderr', action='store_true', help="log to stderr instead of a temp file")
+    parser.add_argument('--sink-latency', type=float, default=0.0002, help="seconds each write blocks (0 for a raw sink)")
+    args = parser.parse_args()
+
+    scenarios = [
+        ('sync basicConfig', lambda stream: setup_sync_logging(stream) or None),
+        ('queue handler', lambda stream: setup_logging(stream=stream, dedup_window=0)),
+        ('queue handler + dedup', lambda stream: setup_logging(stream=stream, dedup_window=30))
+    ]
+
+    print(f"{'scenario':<24}{'log calls':>12}{'lag p50':>12}{'lag p95':>12}{'lag max':>12}")
+    for name, configure in scenarios:
+        with tempfile.TemporaryFile('w+') as sink:
+            stream = sys.stderr if args.stderr else sink
+            if args.sink_latency > 0:
+                stream = SlowStream(stream, args.sink_latency)
+            listener = configure(stream)
+            lags, calls = asyncio.run(run_scenario(args.seconds, args.tasks))
+            if listener:
+                listener.stop()
+        print(
+            f"{name:<24}{calls:>12}"
+            f"{percentile(lags, 50) * 1000:>10.2f}ms"
+            f"{percentile(lags, 95) * 1000:>10.2f}ms"
+            f"{max(lags, default=0) * 1000:>10.2f}ms"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import re
+import json
+import time
+import queue
+import logging
+import threading
+import contextvars
+import logging.handlers
+
+# Fields attached to every record logged while a job is being handled
+log_context = contextvars.ContextVar('log_context', default={})
+
+STRUCTURED_FIELDS = ('job_id', 'user_id', 'suppressed')
+DEDUP_MAX_KEYS = 1000
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        for key, value in log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+class DedupFilter(logging.Filter):
+    """Drop repeats of the same warning/error within a time window.
+
+    Records are keyed by their full message with digits masked plus their
+    job_id, so a job's repeated "Progress update error" or a broadcast's
+    "Failed to send to <id>: <same error>" collapse, while distinct errors
+    and errors from other jobs still get through. Once a window expires a
+    summary record with the ``suppressed`` count is emitted, from a
+    background sweep if no matching record arrives to trigger it.
+    """
+
+    def __init__(self, window=30):
+        super().__init__()
+        self.window = window
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.emit = None
+        self.stopped = threading.Event()
+
+    def start(self, emit):
+        self.emit = emit
+        if self.window > 0:
+            threading.Thread(target=self._sweep_loop, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            for entry in self.seen.values():
+                self._report(entry)
+            self.seen.clear()
+
+    def _sweep_loop(self):
+        while not self.stopped.wait(min(self.window, 5)):
+            with self.lock:
+                self._sweep(time.monotonic())
+
+    def _sweep(self, now):
+        for key, entry in list(self.seen.items()):
+            if now - entry['first'] >= self.window:
+                del self.seen[key]
+                self._report(entry)
+
+    def _report(self, entry):
+        if not entry['suppressed'] or self.emit is None:
+            return
+        record = entry['record']
+        self.emit(logging.makeLogRecord({
+            'name': record.name,
+            'levelno': record.levelno,
+            'levelname': record.levelname,
+            'msg': f"Suppressed {entry['suppressed']} repeats of: {record.getMessage()}",
+            'suppressed': entry['suppressed'],
+            'job_id': getattr(record, 'job_id', None),
+            'user_id': getattr(record, 'user_id', None)
+        }))
+
+    def filter(self, record):
+        if self.window <= 0 or record.levelno < logging.WARNING:
+            return True
+
+        message = re.sub(r'\d+', '#', record.getMessage())
+        key = (record.name, record.levelno, message, getattr(record, 'job_id', None))
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry and now - entry['first'] < self.window:
+                entry['suppressed'] += 1
+                return False
+            if entry:
+                self._report(entry)
+            if len(self.seen) >= DEDUP_MAX_KEYS:
+                self._sweep(now)
+            self.seen[key] = {'first': now, 'suppressed': 0, 'record': record}
+        return True
+
+class LogListener(logging.handlers.QueueListener):
+    def __init__(self, queue, *handlers, dedup=None, **kwargs):
+        super().__init__(queue, *handlers, **kwargs)
+        self.dedup = dedup
+
+    def stop(self):
+        # Report pending suppressed counts before the listener drains
+        if self.dedup:
+            self.dedup.stop()
+        super().stop()
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    # The listener lives in this process, so records are enqueued as-is and
+    # all formatting is left to the listener thread
+    def prepare(self, record):
+        return record
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key in STRUCTURED_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging(level=logging.INFO, stream=None, dedup_window=30):
+    """Route all logging through a queue drained by a background thread.
+
+    Callers on the event loop only pay for a queue put; formatting and the
+    write to ``stream`` (stderr by default) happen on the listener thread.
+    Returns the started ``QueueListener``; call ``stop()`` on exit to flush.
+    """
+    log_queue = queue.SimpleQueue()
+
+    queue_handler = LocalQueueHandler(log_queue)
+    dedup = DedupFilter(dedup_window)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(dedup)
+
+    output_handler = logging.StreamHandler(stream)
+    output_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+
+    listener = LogListener(log_queue, output_handler, dedup=dedup, respect_handler_level=True)
+    listener.start()
+    dedup.start(queue_handler.enqueue)
+    return listener
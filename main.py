@@ -9,6 +9,12 @@ import threading
 import secrets
 import random
 import re
+import signal
+import itertools
+from html import escape
+from collections import Counter
+from types import SimpleNamespace
+from urllib.parse import urlparse
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from pymongo import MongoClient
@@ -16,6 +22,7 @@ from pyrogram import Client, filters, enums
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from pyrogram.errors import BadRequest, FloodWait
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from bot_logging import setup_logging, log_context
 
 # Constants
 ADMIN_ID = 1562465522
@@ -33,11 +40,41 @@ MAX_RETRIES = 2
 CHUNK_SIZE = 4 * 1024 * 1024  # 4MB chunks for faster download
 VERIFY_TUTORIAL = "https://t.me/True12G_offical/96"
 DOWNLOAD_TUTORIAL = "https://t.me/Eagle_Looterz/3189"
+RESTARTING_TEXT = "♻️ <b>Bot is restarting for an update</b>"
+RESEND_LINK_TEXT = RESTARTING_TEXT + "\n\nPlease send your link again in a minute"
+TRACE_BATCH_SIZE = 50
+TRACE_FLUSH_INTERVAL = 5  # Seconds between trace writes to MongoDB
+STATS_MAX_HOURS = 7 * 24
+TRACE_STAGES = ['api_resolve', 'probe', 'thumbnail', 'download', 'dump_upload', 'user_upload']
+DRAIN_DEADLINE = 20  # Seconds short jobs get to finish on shutdown
+CHECKPOINT_TIMEOUT = 5  # Seconds cancelled jobs get to save their checkpoint
+CHECKPOINT_TTL = 6 * 3600
+CHECKPOINT_POLL_INTERVAL = 30
+CHECKPOINT_FIELDS = ['chat_id', 'reply_to_message_id', 'url', 'dl_url', 'filename', 'temp_path', 'thumbnail', 'duration', 'size']
+PROBE_TIMEOUT = 10
+PREFERRED_RESOLUTIONS = ['HD Video']  # Ranked first in 'best' mode, then larger files
+ADMIN_DIGEST_INTERVAL = 60  # Seconds between admin digest messages
+ADMIN_DIGEST_MAX_EVENTS = 200  # Flush early once this many events are pending
+ADMIN_DIGEST_MAX_LINES = 10  # Detail lines kept per event kind
+ADMIN_SHUTDOWN_FLUSH_WAIT = 5  # Max seconds to spend on the final digest during shutdown
+ADMIN_EVENT_LABELS = {
+    'new_user': "👤 New users",
+    'failure': "❌ Failures"
+}
+QUALITY_MODES = {
+    'best': "🎬 Best quality",
+    'saver': "⚡ Data saver"
+}
 
 # Global variables
 active_downloads = {}
 user_download_tasks = {}
 broadcast_posts = {}
+trace_queue = asyncio.Queue(maxsize=10000)
+running_jobs = {}
+bandwidth_reservations = {}  # job_id -> bytes still to download
+owned_temp_files = set()  # temp/thumb paths created by this process
+resuming_users = set()  # Users whose checkpoint was claimed but not yet finished
 
 # Dummy HTTP healthcheck server
 class HealthCheckHandler(BaseHTTPRequestHandler):
@@ -53,10 +90,7 @@ def start_dummy_server():
 threading.Thread(target=start_dummy_server, daemon=True).start()
 
 # Logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+log_listener = setup_logging(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Load .env
@@ -66,6 +100,9 @@ API_HASH = os.getenv("TELEGRAM_API_HASH")
 BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
 MONGODB_URI = os.getenv("MONGODB_URI")
 LINK4EARN_API = os.getenv("LINK4EARN_API")
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_MB", "2000")) * 1024 * 1024  # Telegram bot upload limit
+BANDWIDTH_BUDGET = int(os.getenv("BANDWIDTH_BUDGET_MB", "8192")) * 1024 * 1024  # Bytes allowed in flight
+DEFAULT_QUALITY = os.getenv("DEFAULT_QUALITY", "best")
 
 # MongoDB Initialization
 def initialize_mongodb():
@@ -75,6 +112,7 @@ def initialize_mongodb():
         users_collection = db.users
         verifications_collection = db.verifications
         downloads_collection = db.downloads
+        checkpoints_collection = db.checkpoints
         
         # Create indexes for users_collection
         users_collection.create_index([('user_id', 1)], unique=True)
@@ -101,19 +139,25 @@ def initialize_mongodb():
         verifications_collection.create_index([('user_id', 1)], unique=True)
         verifications_collection.create_index([('token', 1)])
         downloads_collection.create_index([('user_id', 1)])
+        downloads_collection.create_index([('created_at', 1)])
+        checkpoints_collection.create_index([('created_at', 1)], expireAfterSeconds=CHECKPOINT_TTL)
+        checkpoints_collection.create_index([('user_id', 1)])
         
-        return mongo_client, db, downloads_collection, verifications_collection, users_collection
+        return mongo_client, db, downloads_collection, verifications_collection, users_collection, checkpoints_collection
         
     except Exception as e:
         logger.error(f"Failed to initialize MongoDB: {e}")
         raise
 
 try:
-    mongo_client, db, downloads_collection, verifications_collection, users_collection = initialize_mongodb()
+    mongo_client, db, downloads_collection, verifications_collection, users_collection, checkpoints_collection = initialize_mongodb()
 except Exception as e:
     logger.error(f"Critical MongoDB initialization error: {e}")
     exit(1)
 
+class FileTooLarge(Exception):
+    pass
+
 # Helper functions
 def get_ist_time():
     return datetime.utcnow() + IST_OFFSET
@@ -141,6 +185,188 @@ def format_timedelta(td):
     
     return ", ".join(parts)
 
+def format_duration(seconds):
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.1f}s"
+
+# Job tracing
+def new_job_trace(user_id, url):
+    return {
+        'job_id': secrets.token_hex(6),
+        'user_id': user_id,
+        'url': url,
+        'cdn_host': None,
+        'created_at': datetime.utcnow(),
+        'stages': {},
+        'size': 0,
+        'throughput': 0,
+        'retries': 0,
+        'outcome': 'error'
+    }
+
+def record_stage(trace, stage, started):
+    trace['stages'][stage] = round(time.time() - started, 3)
+
+def submit_job_trace(trace):
+    trace['finished_at'] = datetime.utcnow()
+    trace['total_time'] = round((trace['finished_at'] - trace['created_at']).total_seconds(), 3)
+    try:
+        trace_queue.put_nowait(trace)
+    except asyncio.QueueFull:
+        logger.warning(f"Trace queue full, dropping trace {trace['job_id']}")
+
+async def write_traces(batch):
+    try:
+        await asyncio.to_thread(downloads_collection.insert_many, batch, ordered=False)
+    except Exception as e:
+        logger.error(f"Trace write error: {e}")
+
+async def trace_writer():
+    # Batch traces so handlers never wait on MongoDB
+    while True:
+        batch = [await trace_queue.get()]
+        deadline = time.monotonic() + TRACE_FLUSH_INTERVAL
+        try:
+            while len(batch) < TRACE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(trace_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            await write_traces(batch)
+
+async def flush_pending_traces():
+    batch = []
+    while not trace_queue.empty():
+        batch.append(trace_queue.get_nowait())
+    if batch:
+        await write_traces(batch)
+
+def percentile_expr(pct):
+    # Nearest-rank percentile of the pre-sorted '$values' array
+    last_index = {'$subtract': [{'$size': '$values'}, 1]}
+    return {'$arrayElemAt': ['$values', {'$toInt': {'$round': [{'$multiply': [pct / 100, last_index]}, 0]}}]}
+
+def stage_percentiles(since, group_id, value_path, prefix=(), extra=None):
+    """Group traces since ``since`` and return p50/p95 of ``value_path`` per group.
+
+    Values are sorted and reduced to percentiles on the server, so each
+    result row stays small regardless of how many jobs the window holds.
+    """
+    pipeline = [
+        {'$match': {'created_at': {'$gte': since}}},
+        *prefix,
+        {'$match': {value_path: {'$type': 'number'}}},
+        {'$sort': {value_path: 1}},
+        {'$group': {'_id': group_id, 'values': {'$push': f'${value_path}'}, **(extra or {})}},
+        {'$project': {
+            'count': {'$size': '$values'},
+            'p50': percentile_expr(50),
+            'p95': percentile_expr(95),
+            **{key: 1 for key in (extra or {})}
+        }},
+        {'$sort': {'_id': 1}}
+    ]
+    return list(downloads_collection.aggregate(pipeline, allowDiskUse=True))
+
+def aggregate_job_stats(hours):
+    since = datetime.utcnow() - timedelta(hours=hours)
+    return {
+        'outcomes': list(downloads_collection.aggregate([
+            {'$match': {'created_at': {'$gte': since}}},
+            {'$group': {'_id': '$outcome', 'count': {'$sum': 1}}},
+            {'$sort': {'count': -1}}
+        ])),
+        'stages': stage_percentiles(since, '$stages.k', 'stages.v', prefix=[
+            {'$project': {'created_at': 1, 'stages': {'$objectToArray': '$stages'}}},
+            {'$unwind': '$stages'}
+        ]),
+        'hosts': stage_percentiles(
+            since, '$cdn_host', 'stages.download',
+            extra={'throughput': {'$avg': '$throughput'}}
+        ),
+        'hours': stage_percentiles(
+            since, {'$hour': {'date': '$created_at', 'timezone': '+05:30'}}, 'total_time'
+        )
+    }
+
+# Pre-flight resolution probing
+def head_probe(url):
+    r = requests.head(url, allow_redirects=True, timeout=PROBE_TIMEOUT)
+    r.raise_for_status()
+    return int(r.headers.get('content-length', 0)) or None, r.headers.get('content-type', '')
+
+def range_probe(url):
+    # Some CDNs reject HEAD; a one-byte ranged GET still reports the full size
+    with requests.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=PROBE_TIMEOUT) as r:
+        r.raise_for_status()
+        if r.status_code == 206:
+            total = r.headers.get('content-range', '').rsplit('/', 1)[-1]
+            size = int(total) if total.isdigit() else None
+        else:
+            size = int(r.headers.get('content-length', 0)) or None
+        return size, r.headers.get('content-type', '')
+
+async def probe_resolution(label, url):
+    # A resolution whose size can't be probed is still offered, with size None
+    probe = {'label': label, 'url': url, 'size': None, 'content_type': ''}
+    for probe_func in (head_probe, range_probe):
+        try:
+            size, content_type = await asyncio.to_thread(probe_func, url)
+            probe.update(size=size, content_type=content_type.split(';')[0])
+            return probe
+        except Exception as e:
+            logger.warning(f"{probe_func.__name__} failed for {label}: {e}")
+    return probe
+
+async def probe_resolutions(resolutions):
+    return list(await asyncio.gather(*(probe_resolution(label, url) for label, url in resolutions.items() if url)))
+
+def available_bandwidth():
+    return BANDWIDTH_BUDGET - sum(bandwidth_reservations.values())
+
+def reserve_bandwidth(job_id, size):
+    if size:
+        bandwidth_reservations[job_id] = size
+
+def release_bandwidth(job_id):
+    bandwidth_reservations.pop(job_id, None)
+
+def get_quality_preference(user_id):
+    user = users_collection.find_one({'user_id': user_id}, {'quality': 1})
+    quality = (user or {}).get('quality', DEFAULT_QUALITY)
+    return quality if quality in QUALITY_MODES else 'best'
+
+def select_resolution(probes, quality, budget):
+    """Pick the preferred probe that fits the upload limit and bandwidth budget.
+
+    Returns ``(probe, None)`` on success or ``(None, reason)`` where reason is
+    'unavailable', 'too_large' or 'busy'. Probes with unknown size are left to
+    the in-stream limit check in download_with_retry; 'best' ranks by label
+    preference first, 'saver' tries them last.
+    """
+    if not probes:
+        return None, 'unavailable'
+    
+    if quality == 'saver':
+        ranked = sorted(probes, key=lambda p: (p['size'] is None, p['size'] or 0))
+    else:
+        def rank(p):
+            preferred = PREFERRED_RESOLUTIONS.index(p['label']) if p['label'] in PREFERRED_RESOLUTIONS else len(PREFERRED_RESOLUTIONS)
+            return (preferred, p['size'] is None, -(p['size'] or 0))
+        ranked = sorted(probes, key=rank)
+    
+    uploadable = [p for p in ranked if p['size'] is None or p['size'] <= MAX_UPLOAD_SIZE]
+    if not uploadable:
+        return None, 'too_large'
+    
+    for probe in uploadable:
+        if probe['size'] is None or probe['size'] <= budget:
+            return probe, None
+    return None, 'busy'
+
 async def create_verification_link(user_id):
     verifications_collection.delete_many({'user_id': user_id})
     
@@ -198,18 +424,104 @@ def get_verification_status(user_id):
     else:
         return {'status': 'invalid', 'message': "❌ Invalid verification status"}
 
-async def notify_admin_new_user(user):
-    try:
-        await app.send_message(
-            ADMIN_ID,
-            f"<b>👤 New User</b>\n\n"
-            f"<b>Name:</b> {user.first_name}\n"
-            f"<b>Username:</b> @{user.username}\n"
-            f"<b>ID:</b> <code>{user.id}</code>",
-            parse_mode=enums.ParseMode.HTML
+class AdminNotifier:
+    """Coalesce admin events into periodic digest messages.
+
+    notify() only records the event, so handlers never wait on Telegram.
+    run() sends a digest every ADMIN_DIGEST_INTERVAL, or sooner once
+    ADMIN_DIGEST_MAX_EVENTS are pending, and sleeps out any FloodWait while
+    new events keep accumulating for the next digest.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.details = {}
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+
+    def notify(self, kind, text):
+        self.counts[kind] += 1
+        lines = self.details.setdefault(kind, [])
+        if len(lines) < ADMIN_DIGEST_MAX_LINES:
+            lines.append(text)
+        if sum(self.counts.values()) >= ADMIN_DIGEST_MAX_EVENTS:
+            self.wakeup.set()
+
+    def merge(self, counts, details):
+        # Put an unsent snapshot back in front of events recorded since
+        self.counts = counts + self.counts
+        for kind, lines in self.details.items():
+            details.setdefault(kind, []).extend(lines)
+        self.details = {kind: lines[:ADMIN_DIGEST_MAX_LINES] for kind, lines in details.items()}
+
+    def render(self, counts, details):
+        lines = [f"<b>📋 Admin Digest</b> — {format_ist_time(get_ist_time())}", ""]
+        for kind, count in counts.items():
+            lines.append(f"<b>{ADMIN_EVENT_LABELS.get(kind, kind)}:</b> {count}")
+            lines.extend(f"• {text}" for text in details.get(kind, []))
+            if count > len(details.get(kind, [])):
+                lines.append(f"<i>…and {count - len(details.get(kind, []))} more</i>")
+            lines.append("")
+        lines.append(
+            f"<b>Active jobs:</b> {len(running_jobs)} | "
+            f"<b>Free bandwidth:</b> {available_bandwidth()/(1024*1024):.0f}MB | "
+            f"<b>Pending traces:</b> {trace_queue.qsize()}"
         )
-    except Exception as e:
-        logger.error(f"Admin notify error: {e}")
+        return "\n".join(lines)
+
+    async def flush(self, max_wait=None):
+        """Send pending events as one digest.
+
+        With ``max_wait`` set, a FloodWait longer than that many seconds
+        gives up instead of sleeping, so shutdown stays within its grace
+        period. If the flush is cancelled the snapshot is merged back.
+        """
+        if not self.counts:
+            return
+        counts, details = self.counts, self.details
+        self.counts, self.details = Counter(), {}
+        text = self.render(counts, details)
+        
+        try:
+            while True:
+                try:
+                    await app.send_message(ADMIN_ID, text, parse_mode=enums.ParseMode.HTML)
+                    return
+                except FloodWait as e:
+                    if max_wait is not None and e.value > max_wait:
+                        logger.warning(f"Admin digest dropped, FloodWait {e.value}s exceeds {max_wait}s")
+                        return
+                    logger.warning(f"Admin digest FloodWait: {e.value}s")
+                    await asyncio.sleep(e.value)
+                except Exception as e:
+                    logger.error(f"Admin digest error: {e}")
+                    return
+        except asyncio.CancelledError:
+            self.merge(counts, details)
+            raise
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), ADMIN_DIGEST_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+            if self.stopping:
+                return
+
+admin_notifier = AdminNotifier()
+
+def notify_admin_new_user(user):
+    admin_notifier.notify(
+        'new_user',
+        f"{escape(user.first_name or '')} @{user.username} [<code>{user.id}</code>]"
+    )
 
 async def send_to_dump_channel(file_path, filename, size, duration, time_taken, user, thumbnail_url=None):
     try:
@@ -217,6 +529,7 @@ async def send_to_dump_channel(file_path, filename, size, duration, time_taken,
         if thumbnail_url:
             try:
                 thumbnail_path = f"thumb_{user.id}.jpg"
+                owned_temp_files.add(thumbnail_path)
                 with requests.get(thumbnail_url, stream=True, timeout=10) as r:
                     r.raise_for_status()
                     with open(thumbnail_path, 'wb') as f:
@@ -260,40 +573,69 @@ async def send_to_dump_channel(file_path, filename, size, duration, time_taken,
         
         if thumbnail_path and os.path.exists(thumbnail_path):
             os.remove(thumbnail_path)
+            owned_temp_files.discard(thumbnail_path)
+        return True
             
     except Exception as e:
         logger.error(f"Error sending to dump channel: {e}")
+        return False
 
-async def download_with_retry(url, filename, progress_callback, user_id):
+async def download_with_retry(url, filename, progress_callback, user_id, trace=None, expected_size=0):
     active_downloads[user_id] = True
+    started = time.time()
     try:
         for attempt in range(MAX_RETRIES + 1):
+            if trace is not None:
+                trace['retries'] = attempt
+            # Resume from a partial file left by a failed attempt or a checkpointed job
+            offset = os.path.getsize(filename) if os.path.exists(filename) else 0
+            if expected_size and offset > expected_size:
+                os.remove(filename)
+                offset = 0
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
             try:
-                with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as r:
+                    if offset and r.status_code == 416:
+                        if expected_size and offset == expected_size:
+                            return offset  # Already complete before the restart
+                        # Stale or truncated partial file, start over on the next attempt
+                        os.remove(filename)
+                        raise ValueError(f"Partial file ({offset} bytes) doesn't match the remote file")
                     r.raise_for_status()
-                    total_size = int(r.headers.get('content-length', 0))
-                    downloaded = 0
+                    resumed = bool(offset) and r.status_code == 206
+                    initial = offset if resumed else 0
+                    remaining = int(r.headers.get('content-length', 0))
+                    total_size = initial + remaining if remaining else 0  # 0 when the size is unknown
+                    if total_size > MAX_UPLOAD_SIZE:
+                        raise FileTooLarge(f"File is {total_size/(1024*1024):.0f}MB, upload limit is {MAX_UPLOAD_SIZE/(1024*1024):.0f}MB")
+                    downloaded = initial
                     start_time = time.time()
                     last_update = start_time
 
-                    with open(filename, 'wb') as f:
+                    with open(filename, 'ab' if resumed else 'wb') as f:
                         for chunk in r.iter_content(CHUNK_SIZE):
                             if not active_downloads.get(user_id, False):
                                 raise asyncio.CancelledError("Download cancelled")
                                 
                             f.write(chunk)
                             downloaded += len(chunk)
+                            if downloaded > MAX_UPLOAD_SIZE:
+                                raise FileTooLarge(f"File exceeds the {MAX_UPLOAD_SIZE/(1024*1024):.0f}MB upload limit")
                             
                             now = time.time()
                             if now - last_update >= 2:  # Update every 2 seconds
                                 elapsed = now - start_time
-                                speed = downloaded / elapsed if elapsed > 0 else 0
-                                eta = (total_size - downloaded) / speed if speed > 0 else 0
+                                speed = (downloaded - initial) / elapsed if elapsed > 0 else 0
+                                eta = (total_size - downloaded) / speed if speed > 0 and total_size else 0
                                 await progress_callback(downloaded, total_size, speed, eta)
                                 last_update = now
-                    return total_size
+                    if trace is not None:
+                        record_stage(trace, 'download', started)
+                        trace['size'] = downloaded
+                        trace['throughput'] = round((downloaded - initial) / max(time.time() - started, 0.001))
+                    return total_size or downloaded
             except Exception as e:
-                if attempt == MAX_RETRIES:
+                if attempt == MAX_RETRIES or isinstance(e, FileTooLarge):
                     raise
                 logger.warning(f"Attempt {attempt + 1} failed: {str(e)}")
                 await asyncio.sleep(1)
@@ -302,11 +644,21 @@ async def download_with_retry(url, filename, progress_callback, user_id):
         user_download_tasks.pop(user_id, None)
 
 def format_progress(filename, downloaded, total, speed, eta):
+    speed_str = f"{speed/(1024*1024):.2f} MB/s" if speed > 1024*1024 else f"{speed/1024:.2f} KB/s"
+    
+    if not total:
+        # Source sent no Content-Length, so only bytes so far can be shown
+        return (
+            f"<b>📥 Downloading:</b> <code>{filename}</code>\n\n"
+            f"<b>Size:</b> {downloaded/(1024*1024):.1f}MB / unknown\n"
+            f"<b>Speed:</b> {speed_str}\n\n"
+            f"<i>🚀 Powered by @TempGmailTBot</i>"
+        )
+    
     percent = (downloaded / total) * 100
     filled = int(percent / 10)
     progress_bar = '▓' * filled + '░' * (10 - filled)
     
-    speed_str = f"{speed/(1024*1024):.2f} MB/s" if speed > 1024*1024 else f"{speed/1024:.2f} KB/s"
     eta_str = f"{int(eta//3600)}h {int((eta%3600)//60)}m" if eta > 3600 else f"{int(eta//60)}m {int(eta%60)}s" if eta > 60 else f"{int(eta)}s"
     
     return (
@@ -328,6 +680,91 @@ def is_valid_url(text):
         r'(?:/?|[/?]\S+)$', re.IGNORECASE)
     return bool(url_pattern.match(text))
 
+def cleanup_temp_files(keep=()):
+    # Only this process's files: on a shared disk another instance's
+    # in-flight downloads live in the same directory
+    for path in list(owned_temp_files - set(keep)):
+        owned_temp_files.discard(path)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f"Temp cleanup error: {e}")
+
+class LifecycleManager:
+    """Drain jobs on SIGTERM/SIGINT so a redeploy doesn't kill them mid-stream.
+
+    Once shutdown is requested no new jobs are admitted. Every admitted link,
+    from the moment it passes the draining check, is counted until its
+    handler returns. Jobs expected to finish within DRAIN_DEADLINE are given
+    that long; the rest are cancelled and checkpointed to MongoDB so the
+    next instance can resume them.
+    """
+
+    def __init__(self):
+        self.draining = False
+        self.shutdown_requested = asyncio.Event()
+        self.admitted = {}
+        self.admission_ids = itertools.count()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.checkpointed_paths = set()
+
+    def request_shutdown(self):
+        if not self.draining:
+            logger.info("Shutdown requested, draining active jobs")
+            self.draining = True
+            self.shutdown_requested.set()
+
+    async def wait_for_shutdown(self):
+        await self.shutdown_requested.wait()
+
+    def admit(self, chat_id):
+        admission = next(self.admission_ids)
+        self.admitted[admission] = chat_id
+        self.idle.clear()
+        return admission
+
+    def release(self, admission):
+        self.admitted.pop(admission, None)
+        if not self.admitted:
+            self.idle.set()
+
+    async def wait_idle(self, timeout):
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def checkpoint(self, jobs):
+        for job in jobs:
+            if job.get('checkpointing'):
+                continue
+            job['checkpointing'] = True
+            if job['user'].id in active_downloads:
+                active_downloads[job['user'].id] = False
+            job['task'].cancel()
+
+    async def drain(self):
+        logger.info(f"Draining {len(self.admitted)} admitted jobs")
+        
+        self.checkpoint([job for job in running_jobs.values() if job.get('eta', 0) > DRAIN_DEADLINE])
+        await self.wait_idle(DRAIN_DEADLINE)
+        
+        # Jobs still resolving at this point checkpoint themselves on reaching run_download_job
+        self.checkpoint(list(running_jobs.values()))
+        await self.wait_idle(CHECKPOINT_TIMEOUT)
+        
+        for chat_id in set(self.admitted.values()):
+            try:
+                await app.send_message(chat_id, RESEND_LINK_TEXT, parse_mode=enums.ParseMode.HTML)
+            except Exception as e:
+                logger.error(f"Drain notify error: {e}")
+        
+        cleanup_temp_files(keep=self.checkpointed_paths)
+
+lifecycle = LifecycleManager()
+
 # Pyrogram client
 app = Client(
     "koyeb_bot",
@@ -349,7 +786,7 @@ async def start_handler(client, message):
             'last_name': user.last_name or '',
             'joined_at': get_ist_time()
         })
-        await notify_admin_new_user(user)
+        notify_admin_new_user(user)
     
     if len(message.command) > 1 and message.command[1].startswith('verify-'):
         token = message.command[1][7:]
@@ -495,7 +932,7 @@ async def confirm_broadcast(client, callback_query):
             success += 1
             await asyncio.sleep(0.1)  # Rate limiting
         except Exception as e:
-            logger.error(f"Failed to send to {user_id}: {str(e)}")
+            logger.error(f"Failed to send to {user_id}: {str(e)}", extra={'user_id': user_id})
             failed += 1
     
     await processing_msg.edit_text(
@@ -514,6 +951,80 @@ async def cancel_broadcast(client, callback_query):
     await callback_query.message.delete()
     await callback_query.answer("Broadcast cancelled")
 
+@app.on_message(filters.command("stats") & filters.user(ADMIN_ID))
+async def stats_handler(client, message):
+    hours = int(message.command[1]) if len(message.command) > 1 and message.command[1].isdigit() else 24
+    hours = min(max(hours, 1), STATS_MAX_HOURS)
+    
+    try:
+        stats = await asyncio.to_thread(aggregate_job_stats, hours)
+    except Exception as e:
+        logger.error(f"Stats aggregation error: {e}")
+        await message.reply("❌ <b>Failed to load stats</b>", parse_mode=enums.ParseMode.HTML)
+        return
+    
+    outcomes = stats.get('outcomes', [])
+    if not outcomes:
+        await message.reply(f"📊 <b>No jobs in the last {hours}h</b>", parse_mode=enums.ParseMode.HTML)
+        return
+    
+    response = (
+        f"<b>📊 Job Stats (last {hours}h)</b>\n\n"
+        f"<b>Jobs:</b> {sum(o['count'] for o in outcomes)} — "
+        + ", ".join(f"{o['_id']}: {o['count']}" for o in outcomes)
+        + "\n\n<b>Per stage (p50 / p95):</b>\n"
+    )
+    stages = {s['_id']: s for s in stats.get('stages', [])}
+    for stage in TRACE_STAGES + sorted(set(stages) - set(TRACE_STAGES)):
+        if stage in stages:
+            row = stages[stage]
+            response += f"<code>{stage}</code>: {format_duration(row['p50'])} / {format_duration(row['p95'])}\n"
+    
+    response += "\n<b>Per CDN host (download p50 / p95, avg speed):</b>\n"
+    for host in stats.get('hosts', []):
+        response += (
+            f"<code>{host['_id']}</code>: {format_duration(host['p50'])} / "
+            f"{format_duration(host['p95'])}, {(host['throughput'] or 0)/(1024*1024):.2f} MB/s\n"
+        )
+    
+    response += "\n<b>Per hour IST (total p50 / p95):</b>\n"
+    for hour in stats.get('hours', []):
+        response += f"{hour['_id']:02d}:00: {format_duration(hour['p50'])} / {format_duration(hour['p95'])}\n"
+    
+    await message.reply(response[:4096], parse_mode=enums.ParseMode.HTML)
+
+@app.on_message(filters.command("quality"))
+async def quality_handler(client, message):
+    current = get_quality_preference(message.from_user.id)
+    await message.reply(
+        "<b>🎞 Download Quality</b>\n\n"
+        f"<b>Current:</b> {QUALITY_MODES[current]}\n\n"
+        "<i>Best quality picks the highest resolution that fits Telegram's upload limit. "
+        "Data saver picks the smallest file.</i>",
+        parse_mode=enums.ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(label, callback_data=f"quality_{mode}")]
+            for mode, label in QUALITY_MODES.items()
+        ])
+    )
+
+@app.on_callback_query(filters.regex("^quality_"))
+async def quality_callback(client, callback_query):
+    mode = callback_query.data.split('_', 1)[1]
+    if mode not in QUALITY_MODES:
+        await callback_query.answer("Unknown quality option")
+        return
+    
+    users_collection.update_one(
+        {'user_id': callback_query.from_user.id},
+        {'$set': {'quality': mode}}
+    )
+    await callback_query.answer(f"Quality set to {QUALITY_MODES[mode]}")
+    await callback_query.message.edit_text(
+        f"✅ <b>Quality set to {QUALITY_MODES[mode]}</b>",
+        parse_mode=enums.ParseMode.HTML
+    )
+
 @app.on_message(filters.command("restart"))
 async def restart_handler(client, message):
     user_id = message.from_user.id
@@ -532,7 +1043,7 @@ async def restart_handler(client, message):
             parse_mode=enums.ParseMode.HTML
         )
 
-@app.on_message(filters.text & ~filters.command(["start", "status", "restart", "broadcast"]))
+@app.on_message(filters.text & ~filters.command(["start", "status", "restart", "broadcast", "stats", "quality"]))
 async def handle_link(client, message):
     user = message.from_user
     url = message.text.strip()
@@ -548,7 +1059,18 @@ async def handle_link(client, message):
         )
         return
     
-    if user.id in user_download_tasks:
+    if lifecycle.draining:
+        await message.reply(RESEND_LINK_TEXT, parse_mode=enums.ParseMode.HTML)
+        return
+    
+    admission = lifecycle.admit(message.chat.id)
+    try:
+        await process_link(message, user, url)
+    finally:
+        lifecycle.release(admission)
+
+async def process_link(message, user, url):
+    if user.id in user_download_tasks or user.id in resuming_users:
         await message.reply(
             "⏳ <b>You already have a download in progress</b>\n\n"
             "Please wait for it to complete or use /restart to cancel it",
@@ -574,38 +1096,83 @@ async def handle_link(client, message):
         return
     
     rocket_msg = await message.reply("🚀")
+    trace = new_job_trace(user.id, url)
+    # Handler workers are reused across updates, so the context is reset in finally
+    log_token = log_context.set({'job_id': trace['job_id'], 'user_id': user.id})
     
     try:
         try:
+            stage_start = time.time()
             api_url = f"https://true12g.in/api/terabox.php?url={url}"
             api_response = requests.get(api_url, timeout=15).json()
+            record_stage(trace, 'api_resolve', stage_start)
             
             if not api_response.get('response'):
+                trace['outcome'] = 'not_found'
                 await rocket_msg.edit_text("❌ <b>Invalid link or content not available</b>", parse_mode=enums.ParseMode.HTML)
                 return
                 
             file_info = api_response['response'][0]
-            dl_url = file_info['resolutions'].get('HD Video')
             thumbnail = file_info.get('thumbnail', '')
             title = file_info.get('title', url.split('/')[-1][:50])
             duration = file_info.get('duration', 'N/A')
-            ext = mimetypes.guess_extension(requests.head(dl_url).headers.get('content-type', '')) or '.mp4'
+            
+            stage_start = time.time()
+            probes = await probe_resolutions(file_info.get('resolutions') or {})
+            record_stage(trace, 'probe', stage_start)
+            # No await between selecting and reserving, so concurrent links can't overcommit the budget
+            selected, reason = select_resolution(probes, get_quality_preference(user.id), available_bandwidth())
+            if selected:
+                reserve_bandwidth(trace['job_id'], selected['size'])
+            
+            if reason == 'too_large':
+                trace['outcome'] = 'too_large'
+                smallest = min(p['size'] for p in probes)
+                await rocket_msg.edit_text(
+                    "❌ <b>File too large</b>\n\n"
+                    f"<b>Smallest available:</b> {smallest/(1024*1024):.1f}MB\n"
+                    f"<b>Upload limit:</b> {MAX_UPLOAD_SIZE/(1024*1024):.0f}MB",
+                    parse_mode=enums.ParseMode.HTML
+                )
+                return
+            if reason == 'busy':
+                trace['outcome'] = 'busy'
+                await rocket_msg.edit_text(
+                    "⏳ <b>Server is busy right now</b>\n\n"
+                    "<i>Please try again in a few minutes</i>",
+                    parse_mode=enums.ParseMode.HTML
+                )
+                return
+            if not selected:
+                raise ValueError("No downloadable resolution")
+            
+            dl_url = selected['url']
+            size = selected['size'] or 0
+            trace['cdn_host'] = urlparse(dl_url).netloc
+            trace['resolution'] = selected['label']
+            ext = mimetypes.guess_extension(selected['content_type']) or '.mp4'
             filename = f"{title[:50]}{ext}"
             temp_path = f"temp_{user.id}_{int(time.time())}{ext}"
+            owned_temp_files.add(temp_path)
             
         except Exception as e:
+            trace['outcome'] = 'resolve_failed'
             logger.error(f"API request failed: {str(e)}")
+            admin_notifier.notify('failure', f"Resolve [<code>{user.id}</code>]: {escape(str(e)[:100])}")
             await rocket_msg.edit_text("❌ <b>Failed to fetch download info</b>", parse_mode=enums.ParseMode.HTML)
             return
         
         try:
             if thumbnail:
                 thumb_path = f"thumb_{user.id}.jpg"
+                owned_temp_files.add(thumb_path)
+                stage_start = time.time()
                 with requests.get(thumbnail, stream=True, timeout=10) as r:
                     r.raise_for_status()
                     with open(thumb_path, 'wb') as f:
                         for chunk in r.iter_content(1024):
                             f.write(chunk)
+                record_stage(trace, 'thumbnail', stage_start)
                 
                 await rocket_msg.delete()
                 progress_msg = await message.reply_photo(
@@ -619,6 +1186,7 @@ async def handle_link(client, message):
                     has_spoiler=True
                 )
                 os.remove(thumb_path)
+                owned_temp_files.discard(thumb_path)
             else:
                 await rocket_msg.edit_text(
                     f"<b>📥 Starting Download:</b> <code>{filename}</code>\n\n"
@@ -628,69 +1196,21 @@ async def handle_link(client, message):
                 )
                 progress_msg = rocket_msg
 
-            # Define progress callback
-            async def update_progress(downloaded, total, speed, eta):
-                progress_text = format_progress(filename, downloaded, total, speed, eta)
-                try:
-                    await progress_msg.edit_text(
-                        progress_text + 
-                        f"\n\n<b>👤 User:</b> {user.first_name} [<code>{user.id}</code>]",
-                        parse_mode=enums.ParseMode.HTML
-                    )
-                except Exception as e:
-                    logger.error(f"Progress update error: {e}")
-
-            try:
-                user_download_tasks[user.id] = asyncio.create_task(
-                    download_with_retry(dl_url, temp_path, update_progress, user.id)
-                )
-
-                start_time = time.time()
-                size = await user_download_tasks[user.id]
-                download_time = time.time() - start_time
-                
-                await progress_msg.edit_text(
-                    "📤 <b>Uploading to Telegram...</b>\n\n"
-                    f"<b>File:</b> <code>{filename}</code>\n"
-                    f"<b>Size:</b> {size/(1024*1024):.1f}MB\n"
-                    f"<b>Download Time:</b> {download_time:.1f}s\n\n"
-                    f"<b>👤 User:</b> {user.first_name} [<code>{user.id}</code>]",
-                    parse_mode=enums.ParseMode.HTML
-                )
-                
-                await send_to_dump_channel(temp_path, filename, size, duration, download_time, user, thumbnail)
-                
-                await app.send_video(
-                    chat_id=message.chat.id,
-                    video=temp_path,
-                    caption=(
-                        f"✅ <b>Download Complete!</b>\n\n"
-                        f"<b>File:</b> <code>{filename}</code>\n"
-                        f"<b>Size:</b> {size/(1024*1024):.1f}MB\n"
-                        f"<b>Time Taken:</b> {download_time:.1f}s\n\n"
-                        f"<i>⚡ Downloaded via @TempGmailTBot</i>"
-                    ),
-                    supports_streaming=True,
-                    parse_mode=enums.ParseMode.HTML,
-                    reply_to_message_id=message.id,
-                    has_spoiler=True
-                )
-                
-                await progress_msg.delete()
-                
-            except asyncio.CancelledError:
-                await progress_msg.edit_text("❌ <b>Download cancelled</b>", parse_mode=enums.ParseMode.HTML)
-            except Exception as e:
-                logger.error(f"Download failed: {str(e)}")
-                await progress_msg.edit_text(
-                    "❌ <b>Download failed</b>\n\n"
-                    f"<i>Error: {str(e)}</i>",
-                    parse_mode=enums.ParseMode.HTML
-                )
-            finally:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                user_download_tasks.pop(user.id, None)
+            job = {
+                'job_id': trace['job_id'],
+                'user': user,
+                'chat_id': message.chat.id,
+                'reply_to_message_id': message.id,
+                'url': url,
+                'dl_url': dl_url,
+                'filename': filename,
+                'temp_path': temp_path,
+                'thumbnail': thumbnail,
+                'duration': duration,
+                'size': size
+            }
+            # Own task so the lifecycle manager can cancel it without touching the dispatcher worker
+            await asyncio.create_task(run_download_job(job, progress_msg, trace))
                 
         except Exception as e:
             logger.error(f"Error: {str(e)}")
@@ -701,6 +1221,7 @@ async def handle_link(client, message):
             )
             if os.path.exists(temp_path):
                 os.remove(temp_path)
+            owned_temp_files.discard(temp_path)
             user_download_tasks.pop(user.id, None)
     except Exception as e:
         logger.error(f"Error in handle_link: {str(e)}")
@@ -709,6 +1230,232 @@ async def handle_link(client, message):
             f"<i>{str(e)}</i>",
             parse_mode=enums.ParseMode.HTML
         )
+    finally:
+        release_bandwidth(trace['job_id'])
+        submit_job_trace(trace)
+        log_context.reset(log_token)
+
+async def run_download_job(job, progress_msg, trace):
+    user = job['user']
+    filename = job['filename']
+    temp_path = job['temp_path']
+    dl_url = job['dl_url']
+    thumbnail = job['thumbnail']
+    duration = job['duration']
+    
+    if lifecycle.draining:
+        trace['outcome'] = 'checkpointed'
+        await checkpoint_job(job, progress_msg)
+        return
+    
+    job['task'] = asyncio.current_task()
+    running_jobs[job['job_id']] = job
+    
+    # Define progress callback
+    async def update_progress(downloaded, total, speed, eta):
+        job['eta'] = eta
+        if total and job['job_id'] in bandwidth_reservations:
+            bandwidth_reservations[job['job_id']] = max(total - downloaded, 0)
+        progress_text = format_progress(filename, downloaded, total, speed, eta)
+        try:
+            await progress_msg.edit_text(
+                progress_text + 
+                f"\n\n<b>👤 User:</b> {user.first_name} [<code>{user.id}</code>]",
+                parse_mode=enums.ParseMode.HTML
+            )
+        except Exception as e:
+            logger.error(f"Progress update error: {e}")
+
+    try:
+        user_download_tasks[user.id] = asyncio.create_task(
+            download_with_retry(dl_url, temp_path, update_progress, user.id, trace, job.get('size') or 0)
+        )
+
+        start_time = time.time()
+        size = await user_download_tasks[user.id]
+        download_time = time.time() - start_time
+        job['eta'] = 0
+        release_bandwidth(job['job_id'])
+        
+        await progress_msg.edit_text(
+            "📤 <b>Uploading to Telegram...</b>\n\n"
+            f"<b>File:</b> <code>{filename}</code>\n"
+            f"<b>Size:</b> {size/(1024*1024):.1f}MB\n"
+            f"<b>Download Time:</b> {download_time:.1f}s\n\n"
+            f"<b>👤 User:</b> {user.first_name} [<code>{user.id}</code>]",
+            parse_mode=enums.ParseMode.HTML
+        )
+        
+        stage_start = time.time()
+        if await send_to_dump_channel(temp_path, filename, size, duration, download_time, user, thumbnail):
+            record_stage(trace, 'dump_upload', stage_start)
+        else:
+            trace['dump_upload_failed'] = True
+        
+        stage_start = time.time()
+        await app.send_video(
+            chat_id=job['chat_id'],
+            video=temp_path,
+            caption=(
+                f"✅ <b>Download Complete!</b>\n\n"
+                f"<b>File:</b> <code>{filename}</code>\n"
+                f"<b>Size:</b> {size/(1024*1024):.1f}MB\n"
+                f"<b>Time Taken:</b> {download_time:.1f}s\n\n"
+                f"<i>⚡ Downloaded via @TempGmailTBot</i>"
+            ),
+            supports_streaming=True,
+            parse_mode=enums.ParseMode.HTML,
+            reply_to_message_id=job['reply_to_message_id'],
+            has_spoiler=True
+        )
+        record_stage(trace, 'user_upload', stage_start)
+        trace['outcome'] = 'completed'
+        
+        await progress_msg.delete()
+        
+    except asyncio.CancelledError:
+        if job.get('checkpointing'):
+            trace['outcome'] = 'checkpointed'
+            await checkpoint_job(job, progress_msg)
+        else:
+            trace['outcome'] = 'cancelled'
+            await progress_msg.edit_text("❌ <b>Download cancelled</b>", parse_mode=enums.ParseMode.HTML)
+    except Exception as e:
+        trace['outcome'] = 'failed'
+        logger.error(f"Download failed: {str(e)}")
+        admin_notifier.notify('failure', f"Download [<code>{user.id}</code>]: {escape(str(e)[:100])}")
+        await progress_msg.edit_text(
+            "❌ <b>Download failed</b>\n\n"
+            f"<i>Error: {str(e)}</i>",
+            parse_mode=enums.ParseMode.HTML
+        )
+    finally:
+        if not job.get('checkpointed'):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            owned_temp_files.discard(temp_path)
+        user_download_tasks.pop(user.id, None)
+        running_jobs.pop(job['job_id'], None)
+        release_bandwidth(job['job_id'])
+
+async def checkpoint_job(job, progress_msg):
+    temp_path = job['temp_path']
+    checkpoint = {field: job[field] for field in CHECKPOINT_FIELDS}
+    checkpoint.update({
+        'job_id': job['job_id'],
+        'user_id': job['user'].id,
+        'first_name': job['user'].first_name,
+        'offset': os.path.getsize(temp_path) if os.path.exists(temp_path) else 0,
+        'created_at': datetime.utcnow()
+    })
+    
+    try:
+        await asyncio.to_thread(checkpoints_collection.insert_one, checkpoint)
+        job['checkpointed'] = True
+        lifecycle.checkpointed_paths.add(temp_path)
+    except Exception as e:
+        logger.error(f"Checkpoint error: {e}")
+    
+    try:
+        if job.get('checkpointed'):
+            await progress_msg.edit_text(
+                f"{RESTARTING_TEXT}\n\n"
+                f"<b>File:</b> <code>{job['filename']}</code>\n"
+                f"<i>Your download will resume automatically in a moment</i>",
+                parse_mode=enums.ParseMode.HTML
+            )
+        else:
+            await progress_msg.edit_text(RESEND_LINK_TEXT, parse_mode=enums.ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Checkpoint notify error: {e}")
+
+async def resume_job(checkpoint):
+    try:
+        await run_resumed_job(checkpoint)
+    finally:
+        release_bandwidth(checkpoint['job_id'])
+        resuming_users.discard(checkpoint['user_id'])
+
+async def run_resumed_job(checkpoint):
+    user = SimpleNamespace(id=checkpoint['user_id'], first_name=checkpoint['first_name'])
+    trace = new_job_trace(user.id, checkpoint['url'])
+    trace['resumed_from'] = checkpoint['job_id']
+    trace['cdn_host'] = urlparse(checkpoint['dl_url']).netloc
+    log_context.set({'job_id': trace['job_id'], 'user_id': user.id})
+    
+    job = {field: checkpoint.get(field) for field in CHECKPOINT_FIELDS}
+    job.update({'job_id': trace['job_id'], 'user': user, 'size': checkpoint.get('size') or 0})
+    
+    # The partial file only survives when this instance shares the old one's
+    # disk; a fresh container starts empty and the download restarts from 0
+    temp_path = job['temp_path']
+    owned_temp_files.add(temp_path)
+    offset = checkpoint.get('offset') or 0
+    if not offset or not os.path.exists(temp_path) or os.path.getsize(temp_path) != offset:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        offset = 0
+    trace['resume_offset'] = offset
+    
+    if offset:
+        resume_text = (
+            "♻️ <b>Resuming your download</b>\n\n"
+            f"<b>File:</b> <code>{checkpoint['filename']}</code>\n"
+            f"<b>Resuming from:</b> {offset/(1024*1024):.1f}MB"
+        )
+    else:
+        resume_text = (
+            "♻️ <b>Restarting your download</b>\n\n"
+            f"<b>File:</b> <code>{checkpoint['filename']}</code>\n"
+            "<i>The bot was updated, so the download starts over</i>"
+        )
+    
+    admission = lifecycle.admit(checkpoint['chat_id'])
+    # Move the poller's claim-time reservation to this job, sized for the real offset
+    release_bandwidth(checkpoint['job_id'])
+    reserve_bandwidth(job['job_id'], max(job['size'] - offset, 0))
+    try:
+        progress_msg = await app.send_message(
+            checkpoint['chat_id'],
+            resume_text,
+            parse_mode=enums.ParseMode.HTML,
+            reply_to_message_id=checkpoint['reply_to_message_id']
+        )
+        await run_download_job(job, progress_msg, trace)
+    except Exception as e:
+        logger.error(f"Resume error: {e}")
+    finally:
+        release_bandwidth(job['job_id'])
+        submit_job_trace(trace)
+        lifecycle.release(admission)
+
+async def resume_checkpointed_jobs():
+    # Poll rather than scan once: during a rolling deploy the old instance
+    # may still be checkpointing after this one has started
+    while not lifecycle.draining:
+        try:
+            # Only claim a checkpoint whose remaining bytes fit the free bandwidth budget
+            remaining = {'$subtract': [{'$ifNull': ['$size', 0]}, {'$ifNull': ['$offset', 0]}]}
+            checkpoint = await asyncio.to_thread(
+                checkpoints_collection.find_one_and_delete,
+                {
+                    'user_id': {'$nin': list(set(user_download_tasks) | resuming_users)},
+                    '$expr': {'$lte': [remaining, available_bandwidth()]}
+                },
+                sort=[('created_at', 1)]
+            )
+        except Exception as e:
+            logger.error(f"Checkpoint poll error: {e}")
+            checkpoint = None
+        
+        if checkpoint:
+            # Claim the user before the next poll; user_download_tasks is only
+            # filled once run_download_job starts downloading
+            resuming_users.add(checkpoint['user_id'])
+            reserve_bandwidth(checkpoint['job_id'], max((checkpoint.get('size') or 0) - (checkpoint.get('offset') or 0), 0))
+            asyncio.create_task(resume_job(checkpoint))
+        else:
+            await asyncio.sleep(CHECKPOINT_POLL_INTERVAL)
 
 async def cleanup_expired_verifications():
     while True:
@@ -723,7 +1470,15 @@ async def cleanup_expired_verifications():
         await asyncio.sleep(3600)  # Run every hour
 
 async def main():
-    asyncio.create_task(cleanup_expired_verifications())
+    background_tasks = [
+        asyncio.create_task(cleanup_expired_verifications()),
+        asyncio.create_task(trace_writer())
+    ]
+    notifier_task = asyncio.create_task(admin_notifier.run())
+    
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lifecycle.request_shutdown)
     
     try:
         await app.start()
@@ -737,7 +1492,30 @@ async def main():
     except Exception as e:
         logger.error(f"Startup error: {str(e)}")
     
-    await asyncio.Event().wait()
+    background_tasks.append(asyncio.create_task(resume_checkpointed_jobs()))
+    
+    await lifecycle.wait_for_shutdown()
+    await lifecycle.drain()
+    
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await flush_pending_traces()
+    
+    # Let an in-flight digest finish; on timeout wait_for cancels it and the
+    # unsent events are merged back for the final, time-capped flush
+    admin_notifier.stop()
+    try:
+        await asyncio.wait_for(notifier_task, ADMIN_SHUTDOWN_FLUSH_WAIT)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        pass
+    await admin_notifier.flush(max_wait=ADMIN_SHUTDOWN_FLUSH_WAIT)
+    
+    try:
+        await app.stop()
+    except Exception as e:
+        logger.error(f"Shutdown error: {str(e)}")
+    print("Bot stopped gracefully")
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
@@ -747,3 +1525,4 @@ if __name__ == "__main__":
         print("\nBot stopped by user")
     finally:
         loop.close()
+        log_listener.stop()